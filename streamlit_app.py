@@ -1,30 +1,31 @@
 import re
+import hashlib
+import zipfile
+import numpy as np
 import pandas as pd
 import streamlit as st
+import openpyxl
 from io import BytesIO
+from types import MappingProxyType
 import json
 
-# --- MODIFIED: Robust secrets handling ---
-# This try...except block allows the app to run locally without a secrets.toml file
 try:
-    # Check if we have secrets defined (on Streamlit Cloud or in a local file)
-    if "firestore_service_account" in st.secrets:
-        from google.cloud import firestore
-        from google.oauth2 import service_account
-    else:
-        # Secrets file exists, but the key is missing
-        st.warning("Firebase secrets not found. App will run in local-only mode. Rule changes will not be saved.")
-        firestore = None
-except st.errors.StreamlitSecretNotFoundError:
-    # This block runs ONLY if the secrets.toml file is completely missing
-    st.warning("Running in local-only mode (no secrets.toml file found). Rule changes will not be saved.")
-    firestore = None
-# --- END MODIFICATION ---
+    # pyahocorasick is optional; without it die families are matched with a regex
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    # xlsxwriter is optional; without it reports are written with openpyxl
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
 
 
 # --- Default Rule Definitions ---
 # These are used to "seed" the database the first time the app runs.
-DEFAULT_P1_RULES = {
+# They are read-only; load_rules gives each session its own dict copy to edit.
+DEFAULT_P1_RULES = MappingProxyType({
     "Equal Angle / Unequal Angle": {"prod": (180, "Production rate below 180 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (4, "Speed less than 4 mm")},
     "Rectangular Tube": {"prod": (220, "Production rate below 220 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (5.5, "Speed less than 5.5 mm")},
     "Square Tube": {"prod": (280, "Production rate below 280 Prod/hour"), "rec": (82, "Recovery below 82%"), "spd": (5.5, "Speed less than 5.5 mm")},
@@ -38,9 +39,9 @@ DEFAULT_P1_RULES = {
     "Handle / Interlock / Top Bottom": {"prod": (220, "Production rate below 220 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (4.7, "Speed less than 4.7 mm")},
     "Three Track Top": {"prod": (250, "Production rate below 250 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (4.5, "Speed less than 4.5 mm")},
     "Three Track Bottom": {"prod": (330, "Production rate below 330 Prod/hour"), "rec": (82, "Recovery below 82%"), "spd": (5.0, "Speed less than 5.0 mm")},
-}
+})
 
-DEFAULT_P2_RULES = {
+DEFAULT_P2_RULES = MappingProxyType({
     "Equal Angle / Unequal Angle": {"prod": (550, "Production rate below 550 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (5, "Speed less than 5 mm")},
     "Rectangular Tube": {"prod": (300, "Production rate below 300 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (3.5, "Speed less than 3.5 mm")},
     "Square Tube": {"prod": (400, "Production rate below 400 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (3.5, "Speed less than 3.5 mm")},
@@ -64,9 +65,9 @@ DEFAULT_P2_RULES = {
     "Mini Dumal": {"prod": (400, "Production rate below 400 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (3.0, "Speed less than 3.0 mm")},
     "Dumal Shutter": {"prod": (380, "Production rate below 380 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (3.0, "Speed less than 3.0 mm")},
     "40 MM Outer Clip Mullion": {"prod": (280, "Production rate below 280 Prod/hour"), "rec": (80, "Recovery below 80%"), "spd": (5.7, "Speed less than 5.7 mm")},
-}
+})
 
-DEFAULT_FAMILY_KEYWORDS = {
+DEFAULT_FAMILY_KEYWORDS = MappingProxyType({
     # P2 Specific
     "40 mm outer clip mullion": "40 MM Outer Clip Mullion",
     "dumal shutter": "Dumal Shutter",
@@ -104,46 +105,125 @@ DEFAULT_FAMILY_KEYWORDS = {
     "40 mm clip": "40 mm Clip",
     "40 mm outer": "40 mm Outer",
     "40 mm frame": "40 mm Frame",
+})
+
+# P1 rules group some families that P2 checks separately
+P1_FAMILY_REMAP = {
+    "Handle": "Handle / Interlock / Top Bottom",
+    "Interlock": "Handle / Interlock / Top Bottom",
+    "Top Bottom": "Handle / Interlock / Top Bottom",
+    "Single Track Top": "Single Track Top / Single Track Bottom",
+    "Single Track Bottom": "Single Track Top / Single Track Bottom",
+    "Two Track Top": "Two Track Top / Two Track Bottom",
+    "Two Track Bottom": "Two Track Top / Two Track Bottom",
 }
 
-DEFAULT_DEPARTMENT_NUMBER_MAP = {
+DEFAULT_DEPARTMENT_NUMBER_MAP = MappingProxyType({
     1: "Tool Room",
     2: "Production Department",
     3: "Tool Room and Production Department",
     4: "Foundry",
     5: "Maintainance",
     0: "No Department"
-}
+})
+
+# Rule key and the sheet column it is checked against, in reason order
+METRIC_COLUMNS = (("prod", "PROD/HOUR"), ("rec", "RECOVERY %"), ("spd", "Speed(mm)"))
+
+# Columns of the flagged report, in order, and the display names of the sheet columns
+REPORT_COLUMNS = ('Date', 'Press', 'DIE NO.', 'DIE NAME', 'Flagging Reason',
+                  'Operator Name', 'Supervisor Name', 'REMARK', 'Department')
+REPORT_COLUMN_NAMES = MappingProxyType({
+    'DIE NO.': 'Die Number',
+    'DIE NAME': 'Profile Name',
+    'REMARK': 'Remark'
+})
+
+# Rows searched for the 'Remarks' header of the remark mapping sheet
+MAP_HEADER_SCAN_ROWS = 50
+
+# Number of analysed uploads kept in memory by analyze_workbook
+ANALYSIS_CACHE_SIZE = 4
+
+# Reports longer than this are downloaded as a zip of several workbooks
+EXCEL_MAX_ROWS_PER_FILE = 250_000
+
+# Rows of the flagged report shown at a time
+REPORT_PAGE_SIZE = 500
+
+# Number of generated Excel reports kept in memory by build_excel_bytes;
+# one per cached analysis is enough
+EXCEL_CACHE_SIZE = ANALYSIS_CACHE_SIZE
+
+# Whitespace runs removed by normalize_sheet_name
+_WS_RE = re.compile(r"\s+")
+
+# Slashes in the sheet date are not allowed in the download file name
+_SLASH_TBL = str.maketrans('/', '-')
 
 # --- Firestore Initialization ---
 
 @st.cache_resource
 def get_firestore_db():
     """Initializes and returns a Firestore client, or None if setup fails."""
-    if firestore is None:
+    # This check allows the app to run locally without a secrets.toml file
+    try:
+        # Check if we have secrets defined (on Streamlit Cloud or in a local file)
+        if "firestore_service_account" not in st.secrets:
+            # Secrets file exists, but the key is missing
+            st.warning("Firebase secrets not found. App will run in local-only mode. Rule changes will not be saved.")
+            return None
+    except st.errors.StreamlitSecretNotFoundError:
+        # This block runs ONLY if the secrets.toml file is completely missing
+        st.warning("Running in local-only mode (no secrets.toml file found). Rule changes will not be saved.")
         return None
+
     try:
-        # Get credentials from Streamlit Secrets
-        creds_json = {
-            "type": st.secrets["firestore_service_account"]["type"],
-            "project_id": st.secrets["firestore_service_account"]["project_id"],
-            "private_key_id": st.secrets["firestore_service_account"]["private_key_id"],
-            "private_key": st.secrets["firestore_service_account"]["private_key"],
-            "client_email": st.secrets["firestore_service_account"]["client_email"],
-            "client_id": st.secrets["firestore_service_account"]["client_id"],
-            "auth_uri": st.secrets["firestore_service_account"]["auth_uri"],
-            "token_uri": st.secrets["firestore_service_account"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["firestore_service_account"]["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["firestore_service_account"]["client_x509_cert_url"]
-        }
-        
-        creds = service_account.Credentials.from_service_account_info(creds_json)
-        db = firestore.Client(credentials=creds, project=creds_json["project_id"])
-        return db
+        creds = _build_credentials()
+        return _build_client(creds)
+    except ImportError as e:
+        st.error(f"Firebase libraries are not installed. App will run in local-only mode. Error: {e}")
+        return None
     except Exception as e:
         st.error(f"Failed to connect to Firebase. Please check your st.secrets setup. Error: {e}")
         return None
 
+@st.cache_resource(show_spinner=False)
+def _build_credentials():
+    """Builds the service account credentials from Streamlit Secrets once per process."""
+    # The Google client libraries are slow to import, so only load them when they are used
+    from google.oauth2 import service_account
+
+    # Get credentials from Streamlit Secrets
+    creds_json = {
+        "type": st.secrets["firestore_service_account"]["type"],
+        "project_id": st.secrets["firestore_service_account"]["project_id"],
+        "private_key_id": st.secrets["firestore_service_account"]["private_key_id"],
+        "private_key": st.secrets["firestore_service_account"]["private_key"],
+        "client_email": st.secrets["firestore_service_account"]["client_email"],
+        "client_id": st.secrets["firestore_service_account"]["client_id"],
+        "auth_uri": st.secrets["firestore_service_account"]["auth_uri"],
+        "token_uri": st.secrets["firestore_service_account"]["token_uri"],
+        "auth_provider_x509_cert_url": st.secrets["firestore_service_account"]["auth_provider_x509_cert_url"],
+        "client_x509_cert_url": st.secrets["firestore_service_account"]["client_x509_cert_url"]
+    }
+    return service_account.Credentials.from_service_account_info(creds_json)
+
+@st.cache_resource(show_spinner=False)
+def _build_client(_creds):
+    """Creates the Firestore client once per process, so all sessions share its connection pool."""
+    from google.cloud import firestore
+    return firestore.Client(credentials=_creds, project=_creds.project_id)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_rules_doc(_db):
+    """Fetches the stored rules document, or None if it does not exist yet.
+
+    Shared by all sessions for a few minutes; save_rules clears it after a write.
+    """
+    doc = _db.collection("press_analyzer_rules").document("all_rules").get()
+    return doc.to_dict() if doc.exists else None
+
 def load_rules(db):
     """Loads rules from Firestore into session_state, seeding if necessary."""
     if 'rules_loaded' in st.session_state:
@@ -151,9 +231,9 @@ def load_rules(db):
 
     if db is None:
         # No database connection, use local defaults
-        st.session_state.p1_rules = DEFAULT_P1_RULES.copy()
-        st.session_state.p2_rules = DEFAULT_P2_RULES.copy()
-        st.session_state.family_keywords = DEFAULT_FAMILY_KEYWORDS.copy()
+        st.session_state.p1_rules = dict(DEFAULT_P1_RULES)
+        st.session_state.p2_rules = dict(DEFAULT_P2_RULES)
+        st.session_state.family_keywords = dict(DEFAULT_FAMILY_KEYWORDS)
         
         # Convert department map keys to str for JSON compatibility if needed
         st.session_state.department_map = {str(k): v for k, v in DEFAULT_DEPARTMENT_NUMBER_MAP.items()}
@@ -163,22 +243,21 @@ def load_rules(db):
     # Use a single document to store all rules
     doc_ref = db.collection("press_analyzer_rules").document("all_rules")
     try:
-        doc = doc_ref.get()
-        if doc.exists:
+        rules = _fetch_rules_doc(db)
+        if rules is not None:
             # Load rules from DB
-            rules = doc.to_dict()
-            st.session_state.p1_rules = rules.get("p1_rules", DEFAULT_P1_RULES)
-            st.session_state.p2_rules = rules.get("p2_rules", DEFAULT_P2_RULES)
-            st.session_state.family_keywords = rules.get("family_keywords", DEFAULT_FAMILY_KEYWORDS)
+            st.session_state.p1_rules = dict(rules.get("p1_rules", DEFAULT_P1_RULES))
+            st.session_state.p2_rules = dict(rules.get("p2_rules", DEFAULT_P2_RULES))
+            st.session_state.family_keywords = dict(rules.get("family_keywords", DEFAULT_FAMILY_KEYWORDS))
             
             # Firestore stores keys as strings, so we ensure keys are str
             db_dept_map = rules.get("department_map", DEFAULT_DEPARTMENT_NUMBER_MAP)
             st.session_state.department_map = {str(k): v for k, v in db_dept_map.items()}
         else:
             # No rules in DB, seed with defaults
-            st.session_state.p1_rules = DEFAULT_P1_RULES.copy()
-            st.session_state.p2_rules = DEFAULT_P2_RULES.copy()
-            st.session_state.family_keywords = DEFAULT_FAMILY_KEYWORDS.copy()
+            st.session_state.p1_rules = dict(DEFAULT_P1_RULES)
+            st.session_state.p2_rules = dict(DEFAULT_P2_RULES)
+            st.session_state.family_keywords = dict(DEFAULT_FAMILY_KEYWORDS)
             st.session_state.department_map = {str(k): v for k, v in DEFAULT_DEPARTMENT_NUMBER_MAP.items()}
             
             # Save defaults to Firestore
@@ -188,115 +267,263 @@ def load_rules(db):
                 "family_keywords": st.session_state.family_keywords,
                 "department_map": st.session_state.department_map
             })
+            _fetch_rules_doc.clear()
         
         st.session_state.rules_loaded = True
     except Exception as e:
         st.error(f"Error loading rules from Firestore: {e}. Using default rules.")
         # Fallback to defaults
         if 'p1_rules' not in st.session_state:
-            st.session_state.p1_rules = DEFAULT_P1_RULES.copy()
-            st.session_state.p2_rules = DEFAULT_P2_RULES.copy()
-            st.session_state.family_keywords = DEFAULT_FAMILY_KEYWORDS.copy()
+            st.session_state.p1_rules = dict(DEFAULT_P1_RULES)
+            st.session_state.p2_rules = dict(DEFAULT_P2_RULES)
+            st.session_state.family_keywords = dict(DEFAULT_FAMILY_KEYWORDS)
             st.session_state.department_map = {str(k): v for k, v in DEFAULT_DEPARTMENT_NUMBER_MAP.items()}
         st.session_state.rules_loaded = True
 
+def mark_rules_dirty(field):
+    """Records that a rule table (e.g. "p1_rules") was edited and is not saved yet."""
+    st.session_state.setdefault("dirty_rule_fields", set()).add(field)
+
 def save_rules(db):
-    """Saves the current session_state rules to Firestore."""
+    """Saves the rule tables edited in this session to Firestore."""
     if db is None:
         st.warning("Running in local mode. Rule changes will not be saved.")
         return
 
+    dirty_fields = sorted(st.session_state.get("dirty_rule_fields", ()))
     try:
         doc_ref = db.collection("press_analyzer_rules").document("all_rules")
-        doc_ref.set({
-            "p1_rules": st.session_state.p1_rules,
-            "p2_rules": st.session_state.p2_rules,
-            "family_keywords": st.session_state.family_keywords,
-            "department_map": st.session_state.department_map
-        })
+        # Only the edited fields are uploaded; each one is replaced as a whole,
+        # so removed keywords or families do not linger in the stored maps
+        doc_ref.set({field: st.session_state[field] for field in dirty_fields}, merge=dirty_fields)
+        st.session_state.dirty_rule_fields = set()
+        # Other sessions should load the new rules, not the cached document
+        _fetch_rules_doc.clear()
         st.sidebar.success("Rules saved to database!")
     except Exception as e:
         st.sidebar.error(f"Failed to save rules: {e}")
 
-# --- Helper Functions (Now use st.session_state) ---
+# --- Helper Functions (take the rules as arguments, no st.session_state) ---
+
+def build_family_pattern(family_keywords):
+    """Compiles all family keywords into a single regex alternation, longest keyword first."""
+    keywords = sorted(family_keywords, key=len, reverse=True)
+    return re.compile("(" + "|".join(re.escape(kw) for kw in keywords) + ")")
+
+def build_family_automaton(family_keywords):
+    """Builds an Aho-Corasick automaton over all family keywords."""
+    automaton = ahocorasick.Automaton()
+    for kw, family in family_keywords.items():
+        automaton.add_word(kw, (len(kw), family))
+    automaton.make_automaton()
+    return automaton
+
+def find_family(automaton, name_low):
+    """Returns the family of the earliest, longest keyword in a lowercased die name."""
+    best_key, best_family = None, None
+    for end, (length, family) in automaton.iter(name_low):
+        # Same precedence as the regex alternation: leftmost start, then longest keyword
+        key = (end - length, -length)
+        if best_key is None or key < best_key:
+            best_key, best_family = key, family
+    return best_family
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_family_matcher(keyword_items):
+    """Builds the die family matcher once per keyword table, shared across reruns and sessions.
+
+    keyword_items is a sorted tuple of (keyword, family) pairs, so the same table
+    hits the cache whatever order its keys were edited or loaded in.
+    """
+    family_keywords = dict(keyword_items)
+    if ahocorasick is not None:
+        return build_family_automaton(family_keywords)
+    return build_family_pattern(family_keywords)
+
+def get_die_family(names_low, family_keywords):
+    """Maps a Series of lowercased die names to their standardized family names."""
+    if not family_keywords:
+        return pd.Series(None, index=names_low.index, dtype=object)
+    matcher = get_family_matcher(tuple(sorted(family_keywords.items())))
+    # Sheets repeat the same few profiles, so each distinct name is matched only once
+    codes, uniques = pd.factorize(names_low)
+    if ahocorasick is not None:
+        find = lambda name: find_family(matcher, name)
+    else:
+        def find(name):
+            match = matcher.search(name)
+            return family_keywords[match.group(1)] if match else None
+    # Non-string names never match
+    families = [find(name) if isinstance(name, str) else None for name in uniques]
+    # Code -1 (missing name) picks the trailing None
+    return pd.Series(np.array(families + [None], dtype=object)[codes], index=names_low.index)
+
+def build_rule_tables(families, rules):
+    """Flattens a ruleset into NumPy lookup tables indexed by family category code.
+
+    Returns per-metric threshold arrays and a reason table with one row per family
+    and one column per 3-bit combination of failed checks (bit i is the i-th entry
+    of METRIC_COLUMNS). Every table has one extra trailing slot, which is what
+    category code -1 (no family) picks, so it never flags and reports
+    "Die family not found".
+    """
+    rulesets = [rules.get(fam) or {} for fam in families]
+    # Rules loaded from the DB may be lists instead of tuples, so only index into them.
+    thresholds = {
+        key: np.array([rs[key][0] if key in rs else np.nan for rs in rulesets] + [np.nan], dtype=float)
+        for key, _ in METRIC_COLUMNS
+    }
+    reasons = np.full((len(families) + 1, 2 ** len(METRIC_COLUMNS)), np.nan, dtype=object)
+    for i, (fam, rs) in enumerate(zip(families, rulesets)):
+        if not rs:
+            reasons[i] = f"No rules defined for family: {fam}"
+            continue
+        for check in range(1, reasons.shape[1]):
+            msgs = [str(rs[key][1]) for bit, (key, _) in enumerate(METRIC_COLUMNS) if check >> bit & 1 and key in rs]
+            reasons[i, check] = " and ".join(msgs) or np.nan
+    reasons[-1] = "Die family not found"
+    return thresholds, reasons
+
+def apply_flagging_rules(df, press_val, p1_rules, p2_rules):
+    """Applies the flagging logic to all DataFrame rows at once."""
+    # 'Die Family' is categorical: rules are resolved once per distinct family and
+    # gathered onto the rows through the category codes.
+    family = df['Die Family']
+    families = list(family.cat.categories)
 
-def get_die_family(die_name):
-    """Maps a die name string to its standardized family name using session_state rules."""
-    if not isinstance(die_name, str):
-        return None
-    name_low = die_name.lower()
-    # Iterate through keywords from session_state
-    for keyword, family in st.session_state.family_keywords.items():
-        if keyword in name_low:
-            return family
-    return None # No match found
-
-def apply_flagging_rules(row, press_val):
-    """Applies the flagging logic to a single DataFrame row using session_state rules."""
-    family = row['Die Family']
-    prod = row['PROD/HOUR']
-    rec = row['RECOVERY %']
-    spd = row['Speed(mm)']
-    reasons = []
-    ruleset = None
-    
     press_val_std = "N/A"
     if pd.notna(press_val):
         press_val_std = str(press_val).upper().strip()
 
     if "P1" in press_val_std:
-        if family in ["Handle", "Interlock", "Top Bottom"]:
-            family = "Handle / Interlock / Top Bottom"
-        if family in ["Single Track Top", "Single Track Bottom"]:
-            family = "Single Track Top / Single Track Bottom"
-        if family in ["Two Track Top", "Two Track Bottom"]:
-             family = "Two Track Top / Two Track Bottom"
-        ruleset = st.session_state.p1_rules.get(family)
+        families = [P1_FAMILY_REMAP.get(fam, fam) for fam in families]
+        rules = p1_rules
         
     elif "P2" in press_val_std:
-        ruleset = st.session_state.p2_rules.get(family)
+        rules = p2_rules
         
     else:
-        return f"Press '{press_val}' not identified as P1 or P2"
-
-    if ruleset:
-        # Helper to safely get rule, as DB structure might be list
-        def get_rule_val(rule_tuple_or_list):
-            return rule_tuple_or_list[0]
-
-        if pd.notna(prod) and 'prod' in ruleset and prod < get_rule_val(ruleset['prod']):
-            reasons.append(ruleset['prod'][1])
-        if pd.notna(rec) and 'rec' in ruleset and rec < get_rule_val(ruleset['rec']):
-            reasons.append(ruleset['rec'][1])
-        if pd.notna(spd) and 'spd' in ruleset and spd < get_rule_val(ruleset['spd']):
-            reasons.append(ruleset['spd'][1])
-    else:
-        if family: 
-            return f"No rules defined for family: {family}"
-        else: 
-             return "Die family not found"
-
-    return " and ".join(reasons) if reasons else None
-
-@st.cache_data
-def to_excel(df):
-    """Caches the conversion of a DataFrame to an Excel file in memory."""
+        return pd.Series(f"Press '{press_val}' not identified as P1 or P2", index=df.index)
+
+    thresholds, reasons = build_rule_tables(families, rules)
+    codes = family.cat.codes.to_numpy()
+
+    # Pack the failed checks of each row into a 3-bit index into its family's reasons.
+    # NaN values or NaN thresholds compare as False, i.e. never flagged
+    check = np.zeros(len(df), dtype=np.uint8)
+    for bit, (key, col) in enumerate(METRIC_COLUMNS):
+        check |= (df[col].to_numpy(dtype=float) < thresholds[key][codes]).astype(np.uint8) << bit
+    return pd.Series(reasons[codes, check], index=df.index)
+
+def df_fingerprint(df):
+    """Builds a cheap cache key for a DataFrame from its shape, columns and hashed values."""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    digest = hashlib.blake2b(row_hashes.tobytes(), digest_size=16).hexdigest()
+    return (df.shape, tuple(df.columns), digest)
+
+def as_text_cell(worksheet, value):
+    """Returns value, or a text cell for strings openpyxl would otherwise store as a formula."""
+    if isinstance(value, str) and value.startswith('='):
+        # Matches xlsxwriter with strings_to_formulas off: "=..." stays plain text
+        cell = openpyxl.cell.WriteOnlyCell(worksheet, value=value)
+        cell.data_type = 's'
+        return cell
+    return value
+
+def write_excel_workbook(df):
+    """Converts a DataFrame to an Excel file in memory."""
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Flagged_Dies')
+    header = [str(col) for col in df.columns]
+    # Convert every cell once up front; NaN becomes None, which both writers leave blank
+    rows = df.astype(object).where(df.notna(), None).to_numpy().tolist()
+
+    if xlsxwriter is None:
+        # openpyxl's write-only mode streams rows out without building a cell object per value
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Flagged_Dies')
+        header_font = openpyxl.styles.Font(bold=True)
+        header_side = openpyxl.styles.Side(style='thin')
+        header_border = openpyxl.styles.Border(left=header_side, right=header_side, top=header_side, bottom=header_side)
+        header_cells = []
+        for name in header:
+            cell = openpyxl.cell.WriteOnlyCell(worksheet, value=name)
+            cell.font = header_font
+            cell.border = header_border
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        for row in rows:
+            worksheet.append([as_text_cell(worksheet, value) for value in row])
+        workbook.save(output)
+        return output.getvalue()
+
+    # pandas' ExcelWriter emits cells column by column, which constant_memory mode
+    # (one row buffered at a time) cannot handle, so rows are written directly.
+    # Cell text is written as-is: no per-string URL, formula or number detection.
+    # constant_memory also writes strings inline, so no shared string table is kept.
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'strings_to_urls': False,
+        'strings_to_formulas': False,
+        'strings_to_numbers': False,
+        'use_zip64': False,
+    })
+    worksheet = workbook.add_worksheet('Flagged_Dies')
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+    worksheet.write_row(0, 0, header, header_format)
+    for row_idx, row in enumerate(rows, start=1):
+        worksheet.write_row(row_idx, 0, row)
+    workbook.close()
     processed_data = output.getvalue()
     return processed_data
 
+@st.cache_data(hash_funcs={pd.DataFrame: df_fingerprint}, max_entries=EXCEL_CACHE_SIZE, show_spinner=False)
+def build_excel_bytes(df):
+    """Caches the Excel download for a report.
+
+    Reports longer than EXCEL_MAX_ROWS_PER_FILE rows are split into several
+    workbooks bundled in a zip, since Excel struggles with very long sheets.
+    """
+    if len(df) <= EXCEL_MAX_ROWS_PER_FILE:
+        return write_excel_workbook(df)
+
+    output = BytesIO()
+    # Workbooks are already deflate-compressed, so they are stored as-is
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as bundle:
+        for part, start in enumerate(range(0, len(df), EXCEL_MAX_ROWS_PER_FILE), start=1):
+            part_df = df.iloc[start:start + EXCEL_MAX_ROWS_PER_FILE]
+            bundle.writestr(f"flagged_dies_report_part{part}.xlsx", write_excel_workbook(part_df))
+    return output.getvalue()
+
+def read_sheet_rows(wb, sheet_name, min_row=1, max_row=None, max_col=None):
+    """Streams the cell values of a read-only worksheet into a list of row tuples.
+
+    Error cells (#N/A, #REF!, ...) are read as None, as pandas' reader turns them into NaN.
+    """
+    ws = wb[sheet_name]
+    # Some writers store a wrong sheet size; recompute it from the cells, as pandas does
+    ws.reset_dimensions()
+    return [
+        tuple(None if cell.data_type == 'e' else cell.value for cell in row)
+        for row in ws.iter_rows(min_row=min_row, max_row=max_row, max_col=max_col)
+    ]
+
 def normalize_sheet_name(name: str) -> str:
     """Converts sheet names to a standard format for comparison."""
-    return re.sub(r"\s+", "", str(name).strip().lower())
+    return _WS_RE.sub("", str(name).strip().lower())
 
 # --- UI Functions for Sidebar ---
 
 def build_sidebar(db):
     """Creates the sidebar UI for rule management."""
     st.sidebar.title("Rule Management")
-    st.sidebar.info("Rule changes are saved to a central database.")
+    st.sidebar.info("Rule changes are saved to a central database when you click 'Save to database'.")
+
+    # Edits only update this session; they are written in one go from here
+    has_unsaved = bool(st.session_state.get("dirty_rule_fields"))
+    if st.sidebar.button("Save to database", type="primary", disabled=not has_unsaved):
+        save_rules(db)
+    elif has_unsaved:
+        st.sidebar.caption("You have unsaved rule changes.")
     
     # Expander for Family Keywords
     with st.sidebar.expander("Family Keyword Mapping", expanded=False):
@@ -318,7 +545,7 @@ def build_sidebar(db):
             
             if add_kw and kw and fam:
                 st.session_state.family_keywords[kw] = fam
-                save_rules(db)
+                mark_rules_dirty("family_keywords")
                 st.success(f"Saved keyword '{kw}' -> '{fam}'")
                 st.rerun() # Use rerun to update the UI
 
@@ -331,7 +558,7 @@ def build_sidebar(db):
             if remove_kw and kw_to_remove:
                 if kw_to_remove in st.session_state.family_keywords:
                     del st.session_state.family_keywords[kw_to_remove]
-                    save_rules(db)
+                    mark_rules_dirty("family_keywords")
                     st.success(f"Removed keyword '{kw_to_remove}'")
                     st.rerun()
                 else:
@@ -339,20 +566,21 @@ def build_sidebar(db):
 
     # Expander for P1 Rules
     with st.sidebar.expander("P1 Flagging Rules", expanded=False):
-        build_flagging_rule_ui("P1", db)
+        build_flagging_rule_ui("P1")
         
     # Expander for P2 Rules
     with st.sidebar.expander("P2 Flagging Rules", expanded=False):
-        build_flagging_rule_ui("P2", db)
+        build_flagging_rule_ui("P2")
 
-def build_flagging_rule_ui(press_type, db):
+def build_flagging_rule_ui(press_type):
     """Reusable UI for editing P1 or P2 rules."""
     rules_key = f"{press_type.lower()}_rules" # e.g., "p1_rules"
     
     st.write(f"Edit flagging thresholds for Press {press_type}.")
     
-    # Display current rules
-    st.json(st.session_state[rules_key], expanded=False)
+    # Display current rules; only serialized and sent to the browser when asked for
+    if st.toggle(f"Show raw {press_type} rules", value=False, key=f"{rules_key}_show"):
+        st.json(st.session_state[rules_key], expanded=False)
     
     st.write(f"**Add / Edit {press_type} Family Rule**")
     
@@ -405,14 +633,190 @@ def build_flagging_rule_ui(press_type, db):
                 "spd": (spd_thresh, f"Speed less than {spd_thresh} mm")
             }
             
-            # Update session state and save
+            # Update session state; it is written to the database on save
             st.session_state[rules_key][final_family_name] = new_rule
-            save_rules(db)
+            mark_rules_dirty(rules_key)
             st.success(f"Saved rules for family: {final_family_name}")
             st.rerun()
 
 # --- Streamlit App ---
 
+@st.cache_data(show_spinner=False, max_entries=ANALYSIS_CACHE_SIZE)
+def analyze_workbook(raw_bytes, p1_rules, p2_rules, family_keywords, department_map):
+    """Parses an uploaded workbook and builds the flagged dies report.
+
+    Cached on the file content and the rules, so reruns with an unchanged upload
+    skip parsing entirely; the status messages shown while analysing are replayed
+    from the cache. Returns (final_df, date_val), or (None, None) if the sheet
+    could not be analysed.
+    """
+    # Parse the workbook once; every sheet below is streamed from this object
+    wb = openpyxl.load_workbook(BytesIO(raw_bytes), read_only=True, data_only=True)
+    # Normalize every sheet name once; the first sheet wins if two normalize alike
+    norm_map = {}
+    for s in wb.sheetnames:
+        norm_map.setdefault(normalize_sheet_name(s), s)
+    target_sheet = norm_map.get("pressprod")
+
+    if target_sheet is None:
+        wb.close()
+        st.error("❌ No sheet named 'PRESS PROD SHEET' found (case/space-insensitive).")
+        return None, None
+
+    st.success(f"✅ Found sheet: **{target_sheet}**. Extracting and analyzing data...")
+    
+    # --- Load Remark Mapping ---
+    remark_map_sheet_name = norm_map.get("sheet1") or norm_map.get("mapping")
+    
+    remark_to_number_map = {}
+    if remark_map_sheet_name:
+        try:
+            start_row = -1
+            # Try to find the header row "Remarks" near the top of the sheet
+            header_rows = read_sheet_rows(wb, remark_map_sheet_name, max_row=MAP_HEADER_SCAN_ROWS)
+            for i, row in enumerate(header_rows):
+                if 'Remarks' in (str(v) for v in row):
+                    start_row = i + 1
+                    break
+            
+            if start_row == -1:
+                # Fallback: assume data starts from row index 4 (row 5 in Excel)
+                st.warning(f"Could not find 'Remarks' header in {remark_map_sheet_name}, falling back to default row 5.")
+                start_row = 4
+
+            seen_remarks = set()
+            # start_row is 0-based, openpyxl rows are 1-based; only the remark and number columns are read
+            for row in read_sheet_rows(wb, remark_map_sheet_name, min_row=start_row + 1, max_col=2):
+                remark, number = (row + (None, None))[:2]
+                # First occurrence of each raw remark wins, as with drop_duplicates
+                if remark is None or remark in seen_remarks:
+                    continue
+                seen_remarks.add(remark)
+                number = pd.to_numeric(number, errors='coerce')
+                if pd.notna(number):
+                    # Convert number to string for lookup, as map keys are strings
+                    remark_to_number_map[str(remark).strip().lower()] = str(int(number))
+            st.success(f"✅ Found and loaded remark mapping from sheet: **{remark_map_sheet_name}**")
+        except Exception as e:
+            st.error(f"❌ Error loading '{remark_map_sheet_name}' for remark mapping. Error: {e}")
+    else:
+        st.error("❌ Could not find 'Sheet1' or 'Mapping' sheet for remark-to-department.")
+
+    # --- Extract Header Info ---
+    # Only row 5 (B, C, D and L) is read here, so the tiles show before the main table is parsed
+    date_val, press_val, operator_val, supervisor_val = "N/A", "N/A", "N/A", "N/A"
+    try:
+        header_row = read_sheet_rows(wb, target_sheet, min_row=5, max_row=5, max_col=12)[0]
+        date_val = header_row[1]
+        press_val = header_row[2]
+        operator_val = header_row[3]
+        supervisor_val = header_row[11]
+        
+        date_val = str(date_val).split(" ")[0] if pd.notna(date_val) else "N/A"
+        press_val = str(press_val) if pd.notna(press_val) else "N/A"
+        operator_val = str(operator_val) if pd.notna(operator_val) else "N/A"
+        supervisor_val = str(supervisor_val) if pd.notna(supervisor_val) else "N/A"
+
+        st.subheader("Sheet Information")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Date", date_val)
+        col2.metric("Press", press_val)
+        col3.metric("Operator", operator_val)
+        col4.metric("Supervisor", supervisor_val)
+        st.divider()
+    except Exception as e:
+        st.warning(f"Could not extract header info. Error: {e}")
+
+    # --- Read Main Sheet Data ---
+    with st.spinner("Parsing data..."):
+        df_full = pd.DataFrame(read_sheet_rows(wb, target_sheet))
+    wb.close()
+
+    # --- Parse Main Data Table ---
+    try:
+        # Row 7 names win over row 6 (merged parent headers); blank or
+        # "Unnamed" cells in both rows fall back to a positional name.
+        header_row_6 = df_full.iloc[5]
+        header_row_7 = df_full.iloc[6]
+        col_6_vals = header_row_6.astype(str)
+        col_7_vals = header_row_7.astype(str)
+        use_7 = header_row_7.notna() & ~col_7_vals.str.lower().str.contains("unnamed", regex=False, na=False)
+        use_6 = header_row_6.notna() & ~col_6_vals.str.lower().str.contains("unnamed", regex=False, na=False)
+        new_cols = np.where(
+            use_7,
+            col_7_vals.str.strip(),
+            np.where(use_6, col_6_vals.str.strip(), [f"col_{i}" for i in range(len(header_row_6))]),
+        ).tolist()
+        
+        df_data = df_full.iloc[8:]
+        df_data.columns = new_cols
+
+        # --- 6. Filter and Pre-process Data ---
+        if 'DIE NO.' not in df_data.columns or 'DIE NAME' not in df_data.columns:
+            st.error("Error: Missing 'DIE NO.' or 'DIE NAME' column. Cannot proceed.")
+            return None, None
+        
+        # Fully blank rows are dropped silently; they are not counted as filtered out
+        original_row_count = int(df_data.notna().any(axis=1).sum())
+        die_no = pd.to_numeric(df_data['DIE NO.'], errors='coerce')
+        # Normalize names in one pass; reused by the validity mask and the family matcher
+        name_low = df_data['DIE NAME'].map(lambda x: x.strip().lower() if isinstance(x, str) else x)
+        # Build one mask (it also drops blank rows) so the frame is copied once
+        valid = die_no.notna() & name_low.notna() & (name_low != '')
+        df_data = df_data[valid].copy()
+        df_data['DIE NO.'] = die_no[valid]
+        name_low = name_low[valid]
+        
+        if len(df_data) < original_row_count:
+            st.info(f"Filtered out {original_row_count - len(df_data)} rows with invalid 'DIE NO.' or 'DIE NAME'.")
+
+        # --- 7. Perform Analysis ---
+        cols_to_convert = [col for _, col in METRIC_COLUMNS]
+        missing_cols = [col for col in cols_to_convert if col not in df_data.columns]
+        if missing_cols:
+            st.error(f"Error: Missing required column '{missing_cols[0]}'.")
+            return None, None
+        df_data[cols_to_convert] = df_data[cols_to_convert].apply(pd.to_numeric, errors='coerce')
+        
+        # At most a few dozen distinct families, so store them as a categorical
+        df_data['Die Family'] = get_die_family(name_low, family_keywords).astype('category')
+        
+        # Compose remark -> number (a string) -> department (which has string keys)
+        # into one lookup, so the column is mapped once; the few departments are
+        # stored as a categorical
+        remark_to_department = {
+            remark: department_map[number]
+            for remark, number in remark_to_number_map.items()
+            if number in department_map
+        }
+        # Normalize and look up each remark in the same pass, so no lowercased column is built
+        df_data['Department'] = df_data['REMARK'].map(
+            lambda x: remark_to_department.get(str(x).strip().lower(), np.nan) if pd.notna(x) else np.nan
+        ).astype('category')
+        
+        df_data['Flagging Reason'] = apply_flagging_rules(df_data, press_val, p1_rules, p2_rules)
+        
+        # --- 8. Create Flagged Report ---
+        # Copy only the sheet columns the report keeps, not every column of df_data
+        sheet_cols = [col for col in REPORT_COLUMNS if col in df_data.columns]
+        flagged_df = df_data.loc[df_data['Flagging Reason'].notna(), sheet_cols].copy()
+        flagged_df['Date'] = date_val
+        # One press per sheet: a single category, every row pointing at it
+        flagged_df['Press'] = pd.Categorical.from_codes(np.zeros(len(flagged_df), dtype=np.int8), [press_val])
+        flagged_df['Operator Name'] = operator_val
+        flagged_df['Supervisor Name'] = supervisor_val
+        
+        # Under copy-on-write the projection shares flagged_df's data; the report
+        # names are assigned directly since the column order is known
+        final_report_cols = [col for col in REPORT_COLUMNS if col in flagged_df.columns]
+        final_df = flagged_df[final_report_cols]
+        final_df.columns = [REPORT_COLUMN_NAMES.get(col, col) for col in final_report_cols]
+        return final_df, date_val
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        # Missing columns or rows, or cells whose values do not fit the rules
+        st.error(f"Error processing the data table: {e}")
+        return None, None
+
 def main():
     st.set_page_config(page_title="PRESS PROD SHEET Viewer", layout="wide")
     st.title("📘 PRESS PROD SHEET Viewer & Analyst")
@@ -436,176 +840,53 @@ def main():
     if uploaded:
         # Analysis logic only runs if a file is uploaded
         try:
-            xls = pd.ExcelFile(uploaded, engine="openpyxl")
-            target_sheet = None
-            for s in xls.sheet_names:
-                if normalize_sheet_name(s) == "pressprod":
-                    target_sheet = s
-                    break
-
-            if target_sheet is None:
-                st.error("❌ No sheet named 'PRESS PROD SHEET' found (case/space-insensitive).")
-                return
-
-            st.success(f"✅ Found sheet: **{target_sheet}**. Extracting and analyzing data...")
-            
-            # --- Load Remark Mapping ---
-            remark_map_sheet_name = None
-            for s in xls.sheet_names:
-                norm_s = normalize_sheet_name(s)
-                if norm_s == "sheet1" or norm_s == "mapping": 
-                    remark_map_sheet_name = s
-                    break
+            final_df, date_val = analyze_workbook(
+                uploaded.getvalue(),
+                st.session_state.p1_rules,
+                st.session_state.p2_rules,
+                st.session_state.family_keywords,
+                st.session_state.department_map,
+            )
+        except (zipfile.BadZipFile, KeyError) as e:
+            # Not a zip archive, or a zip without the parts of an .xlsx workbook
+            st.error(f"❌ Could not read the uploaded file as an Excel workbook. Error: {e}")
+            return
+        if final_df is None:
+            return
+
+        # --- Display Flagged Report ---
+        st.subheader("🚩 Flagged Dies Report")
+        
+        if final_df.empty:
+            st.success("✅ No dies were flagged based on the provided rules.")
+        else:
+            st.metric("Total Flagged Dies", len(final_df))
+            # Only one page of a large report is sent to the browser; the
+            # download always has every row
+            report_page = final_df
+            if len(final_df) > REPORT_PAGE_SIZE:
+                first_row = st.number_input(
+                    "Show rows starting from",
+                    min_value=1, max_value=len(final_df), value=1, step=REPORT_PAGE_SIZE
+                )
+                report_page = final_df.iloc[first_row - 1:first_row - 1 + REPORT_PAGE_SIZE]
+                st.caption(f"Showing rows {first_row}-{first_row + len(report_page) - 1} of {len(final_df)}.")
+            st.dataframe(report_page, use_container_width=True, hide_index=True)
             
-            remark_to_number_map = {}
-            if remark_map_sheet_name:
-                try:
-                    df_map = pd.read_excel(uploaded, sheet_name=remark_map_sheet_name, engine="openpyxl", header=None)
-                    start_row = -1
-                    # Try to find the header row "Remarks"
-                    for i, row in df_map.iterrows():
-                        # Check if 'Remarks' is in the row values
-                        if 'Remarks' in row.astype(str).values:
-                            start_row = i + 1
-                            break
-                    
-                    if start_row != -1:
-                        # Found header, select data from start_row
-                        df_map = df_map.iloc[start_row:, [0, 1]]
-                    else:
-                        # Fallback: assume data starts from row index 4 (row 5 in Excel)
-                        st.warning(f"Could not find 'Remarks' header in {remark_map_sheet_name}, falling back to default row 5.")
-                        # Reread and slice
-                        df_map = pd.read_excel(uploaded, sheet_name=remark_map_sheet_name, engine="openpyxl", header=None)
-                        df_map = df_map.iloc[4:, [0, 1]]
-
-                    df_map = df_map.dropna(subset=[0])
-                    df_map = df_map.drop_duplicates(subset=[0], keep='first')
-                    df_map[0] = df_map[0].astype(str).str.strip().str.lower()
-                    df_map[1] = pd.to_numeric(df_map[1], errors='coerce')
-                    # Convert number to string for lookup, as map keys are strings
-                    remark_to_number_map = pd.Series(df_map[1].values, index=df_map[0]).dropna().astype(int).astype(str).to_dict()
-                    st.success(f"✅ Found and loaded remark mapping from sheet: **{remark_map_sheet_name}**")
-                except Exception as e:
-                    st.error(f"❌ Error loading '{remark_map_sheet_name}' for remark mapping. Error: {e}")
+            report_name = f"flagged_dies_report_{date_val.translate(_SLASH_TBL)}"
+            if len(final_df) > EXCEL_MAX_ROWS_PER_FILE:
+                file_name, mime = f"{report_name}.zip", "application/zip"
             else:
-                st.error("❌ Could not find 'Sheet1' or 'Mapping' sheet for remark-to-department.")
-
-            # --- Read Main Sheet Data ---
-            df_full = pd.read_excel(uploaded, sheet_name=target_sheet, engine="openpyxl", header=None)
-
-            # --- Extract Header Info ---
-            date_val, press_val, operator_val, supervisor_val = "N/A", "N/A", "N/A", "N/A"
-            try:
-                date_val = df_full.iloc[4, 1]
-                press_val = df_full.iloc[4, 2]
-                operator_val = df_full.iloc[4, 3]
-                supervisor_val = df_full.iloc[4, 11]
-                
-                date_val = str(date_val).split(" ")[0] if pd.notna(date_val) else "N/A"
-                press_val = str(press_val) if pd.notna(press_val) else "N/A"
-                operator_val = str(operator_val) if pd.notna(operator_val) else "N/A"
-                supervisor_val = str(supervisor_val) if pd.notna(supervisor_val) else "N/A"
-
-                st.subheader("Sheet Information")
-                col1, col2, col3, col4 = st.columns(4)
-                col1.metric("Date", date_val)
-                col2.metric("Press", press_val)
-                col3.metric("Operator", operator_val)
-                col4.metric("Supervisor", supervisor_val)
-                st.divider()
-            except Exception as e:
-                st.warning(f"Could not extract header info. Error: {e}")
-
-            # --- Parse Main Data Table ---
-            try:
-                header_row_6 = df_full.iloc[5]
-                header_row_7 = df_full.iloc[6]
-                new_cols = []
-                for i in range(len(header_row_6)):
-                    col_6_val = str(header_row_6[i])
-                    col_7_val = str(header_row_7[i])
-                    if pd.notna(header_row_7[i]) and "unnamed" not in col_7_val.lower():
-                        new_cols.append(col_7_val.strip())
-                    elif pd.notna(header_row_6[i]) and "unnamed" not in col_6_val.lower():
-                        new_cols.append(col_6_val.strip())
-                    else:
-                        new_cols.append(f"col_{i}")
-                
-                df_data = df_full.iloc[8:].copy()
-                df_data.columns = new_cols
-                df_data = df_data.dropna(how='all')
-
-                # --- 6. Filter and Pre-process Data ---
-                if 'DIE NO.' not in df_data.columns or 'DIE NAME' not in df_data.columns:
-                    st.error("Error: Missing 'DIE NO.' or 'DIE NAME' column. Cannot proceed.")
-                    return
-                
-                original_row_count = len(df_data)
-                df_data['DIE NO.'] = pd.to_numeric(df_data['DIE NO.'], errors='coerce')
-                df_data = df_data[pd.notna(df_data['DIE NO.'])]
-                df_data = df_data[pd.notna(df_data['DIE NAME'])]
-                df_data = df_data[df_data['DIE NAME'].astype(str).str.strip() != '']
-                
-                if len(df_data) < original_row_count:
-                    st.info(f"Filtered out {original_row_count - len(df_data)} rows with invalid 'DIE NO.' or 'DIE NAME'.")
-
-                # --- 7. Perform Analysis ---
-                cols_to_convert = ['PROD/HOUR', 'RECOVERY %', 'Speed(mm)']
-                for col in cols_to_convert:
-                    if col in df_data.columns:
-                        df_data[col] = pd.to_numeric(df_data[col], errors='coerce')
-                    else:
-                        st.error(f"Error: Missing required column '{col}'.")
-                        return
-                
-                df_data['Die Family'] = df_data['DIE NAME'].apply(get_die_family)
-                
-                # Map remark string to number (which is now a string)
-                df_data['Department_Number'] = df_data['REMARK'].astype(str).str.strip().str.lower().map(remark_to_number_map)
-                
-                # Use department map from session_state (which has string keys)
-                df_data['Department'] = df_data['Department_Number'].map(st.session_state.department_map)
-                
-                df_data['Flagging Reason'] = df_data.apply(apply_flagging_rules, axis=1, press_val=press_val)
-                
-                # --- 8. Create and Display Flagged Report ---
-                flagged_df = df_data[df_data['Flagging Reason'].notna()].copy()
-                st.subheader("🚩 Flagged Dies Report")
-                
-                if flagged_df.empty:
-                    st.success("✅ No dies were flagged based on the provided rules.")
-                else:
-                    flagged_df['Date'] = date_val
-                    flagged_df['Press'] = press_val
-                    flagged_df['Operator Name'] = operator_val
-                    flagged_df['Supervisor Name'] = supervisor_val
-                    
-                    output_cols = ['Date', 'Press', 'DIE NO.', 'DIE NAME', 'Flagging Reason', 
-                                   'Operator Name', 'Supervisor Name', 'REMARK', 'Department']
-                    final_report_cols = [col for col in output_cols if col in flagged_df.columns]
-                    final_df = flagged_df[final_report_cols].rename(columns={
-                        'DIE NO.': 'Die Number',
-                        'DIE NAME': 'Profile Name',
-                        'REMARK': 'Remark'
-                    })
-                    
-                    st.metric("Total Flagged Dies", len(final_df))
-                    st.dataframe(final_df, use_container_width=True, hide_index=True)
-                    
-                    excel_data = to_excel(final_df)
-                    st.download_button(
-                        label="📥 Download Flagged Report as Excel",
-                        data=excel_data,
-                        file_name=f"flagged_dies_report_{date_val.replace('/', '-')}.xlsx",
-                        mime="application/vnd.ms-excel"
-                    )
-            except Exception as e:
-                st.error(f"Error processing the data table: {e}")
-                st.exception(e)
+                file_name, mime = f"{report_name}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+            # Most visits only view the table, so the workbook is built when the button is clicked
+            st.download_button(
+                label="📥 Download Flagged Report as Excel",
+                data=lambda: build_excel_bytes(final_df),
+                file_name=file_name,
+                mime=mime
+            )
 
-        except Exception as e:
-            st.exception(e)
     else:
         st.info("Please upload an Excel (.xlsx) file to begin analysis.")
 